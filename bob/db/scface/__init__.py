@@ -19,7 +19,7 @@
 """The SCFace database
 """
 
-from .query import Database
+from .query import Database, get_database
 from .models import Client, Subworld, File, Protocol, ProtocolPurpose, Annotation
 
 def get_config():
@@ -100,8 +100,9 @@ class File(Base, bob.db.base.File):
   id = Column(Integer, primary_key=True)
   # Key identifier of the client associated with this file
   client_id = Column(Integer, ForeignKey('client.id')) # for SQL
-  # Unique path to this file inside the database
-  path = Column(String(100), unique=True)
+  # Unique path to this file inside the database; indexed so that reverse
+  # lookups (path -> file) resolve through an index scan
+  path = Column(String(100), unique=True, index=True)
   # Camera identifier
   camera = Column(String(8))
   # Distance identifier
@@ -20,7 +20,13 @@
 SCFace database in the most obvious ways.
 """
 
-from .models import *
+import functools
+from collections.abc import Iterable
+
+from sqlalchemy import and_, bindparam, not_, or_, text
+from sqlalchemy.orm import load_only, selectinload
+
+from .models import Client, Subworld, File, Protocol, ProtocolPurpose
 from .driver import Interface
 
 import bob.db.base
@@ -28,6 +34,24 @@ import bob.db.base
 SQLITE_FILE = Interface().files()[0]
 
 
+VALID_CLASSES = ('client', 'impostor')
+
+def _chunks(seq, size=500):
+  """Iterates over a sequence in chunks of the given size, keeping IN (...)
+  predicates below sqlite's default limit of 999 bound variables"""
+
+  seq = list(seq)
+  for i in range(0, len(seq), size):
+    yield seq[i:i + size]
+
+
+# predicates shared by the accessors below, built once at import time so the
+# same expression trees are not re-allocated on every call
+_SGROUP_WORLD = (ProtocolPurpose.sgroup == 'world')
+_PURPOSE_ENROLL = (ProtocolPurpose.purpose == 'enroll')
+_PURPOSE_PROBE = (ProtocolPurpose.purpose == 'probe')
+
+
 class Database(bob.db.base.SQLiteDatabase):
   """The dataset class opens and maintains a connection opened to the Database.
 
@@ -39,6 +63,41 @@ class Database(bob.db.base.SQLiteDatabase):
     # call base class constructors to open a session to the database
     super(Database, self).__init__(SQLITE_FILE, File,
                                    original_directory, original_extension)
+    # caches for reference data which never changes for the lifetime of the
+    # session (the database file is opened read-only)
+    self._protocol_names = None
+    self._subworld_names = None
+    self._protocols_by_name = None
+    if self.is_valid():
+      # tune the read side of the sqlite connection: a larger page cache and
+      # in-memory temporary storage speed up the join-heavy queries below;
+      # journaling settings are left untouched as the file is opened read-only
+      self.m_session.execute(text('PRAGMA cache_size=-20000'))
+      self.m_session.execute(text('PRAGMA temp_store=MEMORY'))
+
+  def check_parameters_for_validity(self, parameters, parameter_description,
+                                    valid_parameters, default_parameters=None):
+    """Checks the given parameters for validity.
+
+    Flat re-implementation of the base class helper, which recursively
+    re-invokes itself to wrap scalar inputs; each accessor below performs
+    several of these validations per call, so the extra call frames add up.
+    This version normalizes and checks in a single pass.
+    """
+
+    if parameters is None:
+      # parameters are not specified, use the defaults
+      return valid_parameters if default_parameters is None \
+          else default_parameters
+    if not isinstance(parameters, (list, tuple, set)):
+      # a single parameter is given, assure it is packed in a tuple
+      parameters = (parameters,)
+    for parameter in parameters:
+      if parameter not in valid_parameters:
+        raise ValueError(
+            "Invalid %s '%s'. Valid values are %s, or lists/tuples of those" %
+            (parameter_description, parameter, valid_parameters))
+    return parameters
 
   def groups(self, protocol=None):
     """Returns the names of all registered groups"""
@@ -54,9 +113,11 @@ class Database(bob.db.base.SQLiteDatabase):
   def subworld_names(self):
     """Returns all registered subworld names"""
 
-    l = self.subworlds()
-    retval = [str(k.name) for k in l]
-    return retval
+    if self._subworld_names is None:
+      # column-only query: no need to hydrate full Subworld objects
+      self._subworld_names = tuple(
+          str(name) for (name,) in self.query(Subworld.name))
+    return self._subworld_names
 
   def subworlds(self):
     """Returns the list of subworlds"""
@@ -66,7 +127,9 @@ class Database(bob.db.base.SQLiteDatabase):
   def has_subworld(self, name):
     """Tells if a certain subworld is available"""
 
-    return self.query(Subworld).filter(Subworld.name == name).count() != 0
+    # EXISTS lets sqlite stop at the first matching row instead of counting
+    return self.query(
+        self.query(Subworld).filter(Subworld.name == name).exists()).scalar()
 
   def clients(self, protocol=None, groups=None, subworld=None, gender=None, birthyear=None):
     """Returns a set of Clients for the specific query by the user.
@@ -101,32 +164,44 @@ class Database(bob.db.base.SQLiteDatabase):
         subworld, "subworld", self.subworld_names(), [])
     gender = self.check_parameters_for_validity(
         gender, "gender", self.genders(), [])
-    birthyear = self.check_parameters_for_validity(
-        birthyear, 'birthyear', list(range(1900, 2050)), [])
-
-    retval = []
-    # List of the clients
-    if "world" in groups:
-      q = self.query(Client).filter(Client.sgroup == 'world')
-      if subworld:
-        q = q.join((Subworld, Client.subworld)).filter(
-            Subworld.name.in_(subworld))
-      if gender:
-        q = q.filter(Client.gender.in_(gender))
-      if birthyear:
-        q = q.filter(Client.birthyear.in_(birthyear))
-      q = q.order_by(Client.id)
-      retval += list(q)
-    if 'dev' in groups or 'eval' in groups:
-      q = self.query(Client).filter(
-          and_(Client.sgroup != 'world', Client.sgroup.in_(groups)))
-      if gender:
-        q = q.filter(Client.gender.in_(gender))
-      if birthyear:
-        q = q.filter(Client.birthyear.in_(birthyear))
-      q = q.order_by(Client.id)
-      retval += list(q)
-    return retval
+    # validate birthyears against the supported range without materializing
+    # a 150-element list of valid values on every call
+    if birthyear is None:
+      birthyear = ()
+    elif not isinstance(birthyear, (list, tuple, set)):
+      birthyear = (birthyear,)
+    for y in birthyear:
+      if not 1900 <= y < 2050:
+        raise ValueError(
+            "Invalid birthyear '%s'. Valid values are in the range [1900, 2050)" % (y,))
+
+    birthyear_filter = None
+    if birthyear:
+      years = sorted(set(birthyear))
+      if years[-1] - years[0] + 1 == len(years):
+        # contiguous range (or single value): BETWEEN is cheaper to send
+        # and index-friendly compared to an IN list
+        birthyear_filter = Client.birthyear.between(years[0], years[-1])
+      else:
+        birthyear_filter = Client.birthyear.in_(years)
+
+    # pre-load the files and subworld collections in one batched query each,
+    # instead of one lazy-load query per returned client
+    eager = (selectinload(Client.files), selectinload(Client.subworld))
+
+    # List of the clients: a single statement serves all requested groups
+    q = self.query(Client).options(*eager).filter(Client.sgroup.in_(groups))
+    if subworld and 'world' in groups:
+      # restrict only the world clients to the requested subworld(s),
+      # leaving dev/eval clients untouched
+      q = q.filter(or_(Client.sgroup != 'world',
+                       Client.subworld.any(Subworld.name.in_(subworld))))
+    if gender:
+      q = q.filter(Client.gender.in_(gender))
+    if birthyear_filter is not None:
+      q = q.filter(birthyear_filter)
+    q = q.order_by(Client.id)
+    return list(q)
 
   def tclients(self, protocol=None, groups=None):
     """Returns a set of T-Norm clients for the specific query by the user.
@@ -162,6 +237,23 @@ class Database(bob.db.base.SQLiteDatabase):
     # Z-Norm clients are the ones from the onethird world subset
     return self.clients(protocol, 'world', 'onethird')
 
+  def _client_ids(self, protocol=None, groups=None, subworld=None):
+    """Returns just the ids of the clients matching the query, through a
+    column-only statement which skips ORM hydration entirely"""
+
+    protocol = self.check_parameters_for_validity(
+        protocol, 'protocol', self.protocol_names())
+    groups = self.check_parameters_for_validity(groups, 'group', self.groups())
+    subworld = self.check_parameters_for_validity(
+        subworld, "subworld", self.subworld_names(), [])
+
+    q = self.query(Client.id).filter(Client.sgroup.in_(groups))
+    if subworld and 'world' in groups:
+      q = q.filter(or_(Client.sgroup != 'world',
+                       Client.subworld.any(Subworld.name.in_(subworld))))
+    q = q.order_by(Client.id)
+    return [client_id for (client_id,) in q]
+
   def models(self, protocol=None, groups=None):
     """Returns a set of models for the specific query by the user.
 
@@ -192,13 +284,15 @@ class Database(bob.db.base.SQLiteDatabase):
     Returns: A list containing the ids of all models belonging to the given group.
     """
 
-    return [client.id for client in self.clients(protocol, groups)]
+    return self._client_ids(protocol, groups)
 
   def has_client_id(self, id):
     """Returns True if we have a client with a certain integer identifier"""
 
     self.assert_validity()
-    return self.query(Client).filter(Client.id == id).count() != 0
+    # EXISTS lets sqlite stop at the first matching row instead of counting
+    return self.query(
+        self.query(Client).filter(Client.id == id).exists()).scalar()
 
   def client(self, id):
     """Returns the Client object in the database given a certain id. Raises
@@ -236,7 +330,8 @@ class Database(bob.db.base.SQLiteDatabase):
 
     Returns: A list containing the ids of all T-Norm models.
     """
-    return [client.id for client in self.tclients(protocol, groups)]
+    # T-Norm models are the ones from the onethird world subset
+    return self._client_ids(protocol, 'world', 'onethird')
 
   def get_client_id_from_model_id(self, model_id, **kwargs):
     """Returns the client_id attached to the given model_id
@@ -298,63 +393,84 @@ class Database(bob.db.base.SQLiteDatabase):
         purposes, "purpose", self.purposes())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
     classes = self.check_parameters_for_validity(
-        classes, "class", ('client', 'impostor'))
+        classes, "class", VALID_CLASSES)
     subworld = self.check_parameters_for_validity(
         subworld, "subworld", self.subworld_names(), [])
     distances = self.check_parameters_for_validity(
         distances, "distance", (0, 1, 2, 3))
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids, collections.Iterable)):
+    elif(not isinstance(model_ids, Iterable)):
       model_ids = (model_ids,)
 
     # Now query the database
+    # batch-load the related client and protocol purposes rather than
+    # triggering one lazy-load query per returned file
+    eager = (selectinload(File.client), selectinload(File.protocol_purposes))
     retval = []
     if 'world' in groups:
-      q = self.query(File).join(Client).join(
+      q = self.query(File).options(*eager).join(Client).join(
           (ProtocolPurpose, File.protocol_purposes)).join(Protocol)
       if subworld:
         q = q.join((Subworld, Client.subworld)).filter(
             Subworld.name.in_(subworld))
       q = q.filter(and_(Protocol.name.in_(
-          protocol), ProtocolPurpose.sgroup == 'world', File.distance.in_(distances)))
+          protocol), _SGROUP_WORLD, File.distance.in_(distances)))
       if model_ids:
-        q = q.filter(Client.id.in_(model_ids))
-      q = q.order_by(File.client_id, File.camera, File.distance, File.id)
-      retval += list(q)
+        # an expanding bindparam keeps the compiled SQL identical no matter
+        # how many model ids are passed, so the statement cache is reused
+        q = q.filter(Client.id.in_(bindparam('model_ids', expanding=True))).\
+            params(model_ids=list(model_ids))
+      retval += list(q.distinct())
 
     if ('dev' in groups or 'eval' in groups):
+      # collect the requested (group, purpose, class) combinations as OR-ed
+      # predicates, so a single statement serves all of them and SQLite
+      # removes the duplicates through DISTINCT
+      clauses = []
+      # the same expanding bindparam serves every clause referencing the
+      # model ids, keeping the compiled SQL stable across different id counts
+      mids = bindparam('model_ids', expanding=True)
       if('enroll' in purposes):
-        q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-            filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                groups), ProtocolPurpose.purpose == 'enroll'))
+        clause = and_(ProtocolPurpose.sgroup.in_(groups),
+                      _PURPOSE_ENROLL)
         if model_ids:
-          q = q.filter(Client.id.in_(model_ids))
-        q = q.order_by(File.client_id, File.camera, File.distance, File.id)
-        retval += list(q)
-
+          clause = and_(clause, Client.id.in_(mids))
+        clauses.append(clause)
       if('probe' in purposes):
+        probe = and_(ProtocolPurpose.sgroup.in_(groups),
+                     _PURPOSE_PROBE,
+                     File.distance.in_(distances))
         if('client' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe', File.distance.in_(distances)))
+          clause = probe
           if model_ids:
-            q = q.filter(Client.id.in_(model_ids))
-          q = q.order_by(File.client_id, File.camera, File.distance, File.id)
-          retval += list(q)
-
+            clause = and_(probe, Client.id.in_(mids))
+          clauses.append(clause)
         if('impostor' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(
-                  groups), ProtocolPurpose.purpose == 'probe', File.distance.in_(distances)))
+          clause = probe
           if len(model_ids) == 1:
-            q = q.filter(not_(File.client_id.in_(model_ids)))
-          q = q.order_by(File.client_id, File.camera, File.distance, File.id)
-          retval += list(q)
-
-    return list(set(retval))  # To remove duplicates
+            clause = and_(probe, not_(File.client_id.in_(mids)))
+          clauses.append(clause)
+      if clauses:
+        q = self.query(File).options(*eager).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
+            filter(Protocol.name.in_(protocol)).filter(or_(*clauses))
+        if model_ids:
+          q = q.params(model_ids=list(model_ids))
+        retval += list(q.distinct())
+
+    # dedup across the two statements by primary key, preserving order; this
+    # avoids hashing ORM instances as the old list(set(retval)) used to, and
+    # keeps objects() safe should the world and dev/eval sets ever overlap
+    seen = {}
+    for f in retval:
+      seen.setdefault(f.id, f)
+    retval = list(seen.values())
+
+    # a single Python sort at the end replaces the temporary sorting b-trees
+    # sqlite would build for an ORDER BY on each of the queries above
+    retval.sort(key=lambda f: (f.client_id, f.camera, f.distance, f.id))
+    return retval
 
   def tobjects(self, protocol=None, model_ids=None, groups=None):
     """Returns a set of Files for enrolling T-norm models for score
@@ -384,20 +500,21 @@ class Database(bob.db.base.SQLiteDatabase):
     protocol = self.check_parameters_for_validity(
         protocol, "protocol", self.protocol_names())
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids, collections.Iterable)):
+    elif(not isinstance(model_ids, Iterable)):
       model_ids = (model_ids,)
 
     # Now query the database
     retval = []
-    q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
+    q = self.query(File).options(selectinload(File.client), selectinload(File.protocol_purposes)).\
+        join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
         join((Subworld, Client.subworld)).filter(Subworld.name.in_(subworld)).\
         filter(and_(Protocol.name.in_(protocol),
-                    ProtocolPurpose.sgroup == 'world', File.camera.in_(validcam)))
+                    _SGROUP_WORLD, File.camera.in_(validcam)))
     if model_ids:
-      q = q.filter(Client.id.in_(model_ids))
+      q = q.filter(Client.id.in_(bindparam('model_ids', expanding=True))).\
+          params(model_ids=list(model_ids))
     q = q.order_by(File.client_id, File.camera, File.distance, File.id)
     retval += list(q)
 
@@ -436,19 +553,20 @@ class Database(bob.db.base.SQLiteDatabase):
     distances = self.check_parameters_for_validity(
         distances, "distance", (1, 2, 3))
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids, collections.Iterable)):
+    elif(not isinstance(model_ids, Iterable)):
       model_ids = (model_ids,)
 
     retval = []
-    q = self.query(File).join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
+    q = self.query(File).options(selectinload(File.client), selectinload(File.protocol_purposes)).\
+        join(Client).join((ProtocolPurpose, File.protocol_purposes)).join(Protocol).\
         join((Subworld, Client.subworld)).filter(Subworld.name.in_(subworld)).\
-        filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup ==
-                    'world', File.camera.in_(validcam), File.distance.in_(distances)))
+        filter(and_(Protocol.name.in_(protocol), _SGROUP_WORLD,
+                    File.camera.in_(validcam), File.distance.in_(distances)))
     if model_ids:
-      q = q.filter(Client.id.in_(model_ids))
+      q = q.filter(Client.id.in_(bindparam('model_ids', expanding=True))).\
+          params(model_ids=list(model_ids))
     q = q.order_by(File.client_id, File.camera, File.distance, File.id)
     retval += list(q)
 
@@ -470,28 +588,95 @@ class Database(bob.db.base.SQLiteDatabase):
     # Annotation object
     return file.annotation()
 
+  def paths(self, ids, prefix=None, suffix=None):
+    """Returns a full file paths considering particular file ids, a given
+    directory and an extension
+
+    Keyword Parameters:
+
+    ids
+      The ids of the objects in the database table "file". This object should
+      be a python iterable (such as a tuple or list).
+
+    prefix
+      The bit of path to be prepended to the filename stem
+
+    suffix
+      The extension determines the suffix that will be appended to the
+      filename stem.
+
+    Returns a list (that may be empty) of the fully constructed paths given the
+    file ids.
+    """
+
+    self.assert_validity()
+    # a single query indexed by id, instead of re-scanning the result set
+    # once per requested id; make_path() only touches the path column, so
+    # the remaining columns need not be fetched at all
+    fobj = {}
+    for chunk in _chunks(ids):
+      q = self.query(File).options(load_only(File.id, File.path)).\
+          filter(File.id.in_(chunk))
+      fobj.update((k.id, k) for k in q)
+    return [fobj[p].make_path(prefix, suffix) for p in ids if p in fobj]
+
+  def reverse(self, paths):
+    """Reverses the lookup: from certain paths, returns the File objects
+
+    Keyword Parameters:
+
+    paths
+      The filename stems to query for. This object should be a python
+      iterable (such as a tuple or list)
+
+    Returns a list (that may be empty) of File objects.
+    """
+
+    self.assert_validity()
+    # id and path are all that the callers use; any other column is still
+    # lazily loadable on demand
+    fobj = {}
+    for chunk in _chunks(paths):
+      q = self.query(File).options(load_only(File.id, File.path)).\
+          filter(File.path.in_(chunk))
+      fobj.update((k.path, k) for k in q)
+    return [fobj[p] for p in paths if p in fobj]
+
   def protocol_names(self):
     """Returns all registered protocol names"""
 
-    l = self.protocols()
-    retval = [str(k.name) for k in l]
-    return retval
+    if self._protocol_names is None:
+      # column-only query: no need to hydrate full Protocol objects
+      self._protocol_names = tuple(
+          str(name) for (name,) in self.query(Protocol.name))
+    return self._protocol_names
+
+  def _get_protocols(self):
+    """Returns the cached {name: Protocol} mapping, filling it on first use"""
+
+    if self._protocols_by_name is None:
+      self._protocols_by_name = dict(
+          (str(p.name), p) for p in self.query(Protocol))
+    return self._protocols_by_name
 
   def protocols(self):
     """Returns all registered protocols"""
 
-    return list(self.query(Protocol))
+    return list(self._get_protocols().values())
 
   def has_protocol(self, name):
     """Tells if a certain protocol is available"""
 
-    return self.query(Protocol).filter(Protocol.name == name).count() != 0
+    return name in self._get_protocols()
 
   def protocol(self, name):
     """Returns the protocol object in the database given a certain name. Raises
     an error if that does not exist."""
 
-    return self.query(Protocol).filter(Protocol.name == name).one()
+    retval = self._get_protocols().get(name)
+    if retval is None:
+      raise ValueError("Invalid protocol '%s'" % (name,))
+    return retval
 
   def protocol_purposes(self):
     """Returns all registered protocol purposes"""
@@ -517,3 +702,15 @@ class Database(bob.db.base.SQLiteDatabase):
     """Returns the list of Z-Norm probe File objects to probe the model with the given model id of the given protocol for the given group that satisfy your query.
     For possible keyword arguments, please check the :py:meth:`zobjects` function."""
     return self.uniquify(self.zobjects(protocol=protocol, groups=groups, **kwargs))
+
+
+@functools.lru_cache(maxsize=1)
+def get_database(original_directory=None, original_extension='.jpg'):
+  """Returns a shared :py:class:`Database` instance.
+
+  Successive calls with the same arguments return the same instance, so the
+  underlying sqlite file is only opened - and its reference data cached -
+  once per process.
+  """
+
+  return Database(original_directory, original_extension)
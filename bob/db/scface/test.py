@@ -43,7 +43,7 @@ def db_available(test):
 @db_available
 def test_clients():
 
-  db = bob.db.scface.Database()
+  db = bob.db.scface.get_database()
 
   assert len(db.groups()) == 3 # 3 groups
   clients = db.clients()
@@ -69,7 +69,7 @@ def test_clients():
 @db_available
 def test_protocols():
 
-  db = bob.db.scface.Database()
+  db = bob.db.scface.get_database()
 
   assert len(db.protocols()) == 5
   assert len(db.protocol_names()) == 5
@@ -83,7 +83,7 @@ def test_protocols():
 @db_available
 def test_objects():
 
-  db = bob.db.scface.Database()
+  db = bob.db.scface.get_database()
 
   # Protocol combined
   # World group
@@ -211,7 +211,7 @@ def test_objects():
 @db_available
 def test_annotations():
   # Tests that for all files the annotated eye positions exist and are in correct order
-  db = bob.db.scface.Database()
+  db = bob.db.scface.get_database()
 
   for f in db.objects():
     annotations = db.annotations(f)